@@ -1,107 +1,210 @@
-import traceback
-from contextlib import AsyncExitStack, asynccontextmanager
-from typing import AsyncContextManager, AsyncIterator, Callable, Dict, TypeVar
+from typing import (
+    AsyncContextManager,
+    Awaitable,
+    Callable,
+    TypeVar,
+    Union,
+    cast,
+)
 
 from asgi_lifespan_middleware._types import ASGIApp, Message, Receive, Scope, Send
 
+try:  # pragma: no cover
+    from inspect import markcoroutinefunction  # type: ignore[attr-defined]
+except ImportError:  # pragma: no cover
+    from asyncio.coroutines import _is_coroutine  # type: ignore[attr-defined]
+
+    CallableT = TypeVar("CallableT")
+
+    def markcoroutinefunction(func: CallableT) -> CallableT:
+        # legacy marker honored by asyncio.iscoroutinefunction,
+        # which ASGI servers use to tell ASGI 3 apps from ASGI 2 apps
+        func._is_coroutine = _is_coroutine  # type: ignore[attr-defined]
+        return func
+
+
 WrappedApp = TypeVar("WrappedApp", bound=ASGIApp)
 
 
-Lifespan = Callable[[WrappedApp], AsyncContextManager[None]]
+# either a factory called with the wrapped app (Starlette-style) or a
+# ready-made async context manager to enter as-is
+Lifespan = Union[
+    Callable[[WrappedApp], AsyncContextManager[None]],
+    AsyncContextManager[None],
+]
+
+
+# bit flags for the lifespan events we care about; cheaper to set and
+# test than a dict keyed by the message type strings
+_STARTUP_COMPLETE = 1
+_STARTUP_FAILED = 2
+_SHUTDOWN_COMPLETE = 4
+_SHUTDOWN_FAILED = 8
+
+# receivers of ASGI messages must treat them as read-only, so the two
+# fixed "complete" messages can be shared instead of rebuilt per cycle
+_STARTUP_COMPLETE_MSG: Message = {"type": "lifespan.startup.complete"}
+_SHUTDOWN_COMPLETE_MSG: Message = {"type": "lifespan.shutdown.complete"}
+
+
+class _LifespanState:
+    """Per-cycle state shared between the send wrapper and the failure
+    reporting in _handle_lifespan.
+
+    One __slots__ instance with a bound wrapped_send method replaces the
+    closures and mutable containers __call__ used to allocate per cycle.
+    """
+
+    __slots__ = ("send", "flags")
+
+    def __init__(self, send: Send) -> None:
+        self.send = send
+        self.flags = 0
+
+    async def wrapped_send(self, message: Message) -> None:
+        message_type = message["type"]
+        if message_type == "lifespan.shutdown.complete":
+            self.flags |= _SHUTDOWN_COMPLETE
+            # we want to send this one ourselves
+            # once we are done
+            return
+        if message_type == "lifespan.startup.complete":
+            self.flags |= _STARTUP_COMPLETE
+        elif message_type == "lifespan.startup.failed":
+            self.flags |= _STARTUP_FAILED
+        elif message_type == "lifespan.shutdown.failed":
+            self.flags |= _SHUTDOWN_FAILED
+        await self.send(message)
 
 
 class LifespanMiddleware:
-    __slots__ = ("_app", "_lifespan")
+    __slots__ = ("_app", "_lifespan", "_lifespan_is_cm", "_assume_lifespan")
 
-    def __init__(self, app: WrappedApp, *, lifespan: Lifespan[WrappedApp]) -> None:
+    def __init__(
+        self,
+        app: WrappedApp,
+        *,
+        lifespan: Lifespan[WrappedApp],
+        assume_lifespan: bool = False,
+    ) -> None:
         self._app = app
         self._lifespan = lifespan
+        # detect once at construction whether the lifespan is already a
+        # context manager so we don't pay a factory call per cycle.
+        # isinstance (not hasattr) so that a class passed as the factory
+        # isn't mistaken for a context manager instance
+        self._lifespan_is_cm = isinstance(lifespan, AsyncContextManager)
+        # set assume_lifespan=True if the wrapped app is known to
+        # implement the lifespan protocol (e.g. Starlette, FastAPI);
+        # we then skip the machinery for apps that don't support it
+        self._assume_lifespan = assume_lifespan
 
-    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+    # a plain def so that non-lifespan scopes (every HTTP request and
+    # WebSocket connection) don't pay for an extra coroutine frame;
+    # we hand the wrapped app's coroutine straight back to the server.
+    # marked as a coroutine function so servers still detect us as ASGI 3
+    @markcoroutinefunction
+    def __call__(self, scope: Scope, receive: Receive, send: Send) -> Awaitable[None]:
         if scope["type"] != "lifespan":  # pragma: no cover
-            await self._app(scope, receive, send)
-            return
-
-        rcv_events: Dict[str, bool] = {}
-        send_events: Dict[str, bool] = {}
+            return self._app(scope, receive, send)
+        return self._handle_lifespan(scope, receive, send)
 
-        async def wrapped_rcv() -> Message:
-            message = await receive()
-            rcv_events[message["type"]] = True
-            return message
+    async def _handle_lifespan(
+        self, scope: Scope, receive: Receive, send: Send
+    ) -> None:
+        state = _LifespanState(send)
 
-        async def wrapped_send(message: Message) -> None:
-            send_events[message["type"]] = True
-            if message["type"] == "lifespan.shutdown.complete":
-                # we want to send this one ourselves
-                # once we are done
-                return
-            await send(message)
+        if self._lifespan_is_cm:
+            lifespan_cm = cast(AsyncContextManager[None], self._lifespan)
+        else:
+            lifespan_cm = cast(
+                Callable[[ASGIApp], AsyncContextManager[None]], self._lifespan
+            )(self._app)
 
-        @asynccontextmanager
-        async def cleanup() -> "AsyncIterator[None]":
+        # hand-rolled equivalent of entering lifespan_cm with
+        # `async with` and reporting the outcome from an outer context
+        # manager: a flat try/except saves two __aenter__/__aexit__
+        # coroutine dispatches per cycle. the inner handler mirrors
+        # `async with lifespan_cm` semantics (including suppression),
+        # the outer handler reports the outcome to the ASGI server
+        try:
+            entered = False
             try:
-                yield
-            except BaseException:
-                exc_text = traceback.format_exc()
-                if "lifespan.startup.complete" in send_events:
-                    await send(
-                        {"type": "lifespan.shutdown.failed", "message": exc_text}
-                    )
+                await lifespan_cm.__aenter__()
+                entered = True
+                if self._assume_lifespan:
+                    # the deployer vouched that the app implements the
+                    # lifespan protocol, so skip the exception handling
+                    # and server handshake needed for apps that don't
+                    await self._app(scope, receive, state.wrapped_send)
                 else:
-                    await send({"type": "lifespan.startup.failed", "message": exc_text})
-                raise
-            else:
-                await send({"type": "lifespan.shutdown.complete"})
-
-        lifespan_cm = self._lifespan(self._app)
-
-        async with AsyncExitStack() as stack:
-            await stack.enter_async_context(cleanup())
-            await stack.enter_async_context(lifespan_cm)
-            try:
-                # one of 4 things will happen when we call the app:
-                # 1. it supports lifespans. it will block until the server
-                #    sends the shutdown signal, at which point we get control
-                #    back and can run our own teardown
-                # 2. it does nothing and returns. in this case we do the
-                #    back and forth with the ASGI server ourselves
-                # 3. it raises an exception.
-                #    a. before raising the exception it sent a
-                #       "lifespan.startup.failed" message
-                #       this means it supports lifespans, but it's lifespan
-                #       errored out. we'll re-raise to trigger our teardown
-                #    b. it did not send a "lifespan.startup.failed" message
-                #       this app doesn't support lifespans, the spec says
-                #       to just swallow the exception and proceed
-                # 4. it supports lifespan events and it's lifespan fails
-                #    (it sends a "lifespan.startup.failed" message)
-                #    in this case we'll run our teardown and then return
-                await self._app(scope, wrapped_rcv, wrapped_send)
-            except BaseException:
-                if (
-                    "lifespan.startup.failed" in send_events
-                    or "lifespan.shutdown.failed" in send_events
+                    try:
+                        # one of 4 things will happen when we call the app:
+                        # 1. it supports lifespans. it will block until the
+                        #    server sends the shutdown signal, at which point
+                        #    we get control back and can run our own teardown
+                        # 2. it does nothing and returns. in this case we do
+                        #    the back and forth with the ASGI server ourselves
+                        # 3. it raises an exception.
+                        #    a. before raising the exception it sent a
+                        #       "lifespan.startup.failed" message
+                        #       this means it supports lifespans, but it's
+                        #       lifespan errored out. we'll re-raise to
+                        #       trigger our teardown
+                        #    b. it did not send a "lifespan.startup.failed"
+                        #       message
+                        #       this app doesn't support lifespans, the spec
+                        #       says to just swallow the exception and proceed
+                        # 4. it supports lifespan events and it's lifespan
+                        #    fails (it sends a "lifespan.startup.failed"
+                        #    message)
+                        #    in this case we'll run our teardown and then
+                        #    return
+                        await self._app(scope, receive, state.wrapped_send)
+                    except BaseException:
+                        if state.flags & (_STARTUP_FAILED | _SHUTDOWN_FAILED):
+                            # the app tried to start and failed
+                            # this app re-raises the exceptions (Starlette
+                            # does this)
+                            # re-raise so that our teardown is triggered
+                            raise
+                        # the app doesn't support lifespans
+                        # the spec says to ignore these errors and just don't
+                        # send more lifespan events
+                    if not state.flags & (_STARTUP_COMPLETE | _STARTUP_FAILED):
+                        # the app doesn't support lifespans at all
+                        # so we'll have to talk to the ASGI server ourselves.
+                        # if it sent either startup message it consumed the
+                        # server's startup event itself, so another receive()
+                        # here would block on a message that never comes; all
+                        # that's left then is to run our teardown and exit
+                        await receive()
+                        await send(_STARTUP_COMPLETE_MSG)
+                        # we'll block here until the ASGI server shuts us down
+                        await receive()
+                entered = False
+                await lifespan_cm.__aexit__(None, None, None)
+            except BaseException as exc:
+                if not (
+                    entered
+                    and await lifespan_cm.__aexit__(type(exc), exc, exc.__traceback__)
                 ):
-                    # the app tried to start and failed
-                    # this app re-raises the exceptions (Starlette does this)
-                    # re-raise so that our teardown is triggered
                     raise
-                # the app doesn't support lifespans
-                # the spec says to ignore these errors and just don't send
-                # more lifespan events
-            if "lifespan.startup.failed" in send_events:
-                # the app supports lifespan events
-                # but it failed to start
-                # this app does not re-raise exceptions
-                # so all we can do is run our teardown and exit
-                return
-            if "lifespan.startup.complete" not in send_events:
-                # the app doesn't support lifespans at all
-                # so we'll have to talk to the ASGI server ourselves
-                await receive()
-                await send({"type": "lifespan.startup.complete"})
-                # we'll block here until the ASGI server shuts us down
-                await receive()
-        # even if the app sent this, we intercepted it and discarded it until we were done
-        await send({"type": "lifespan.shutdown.complete"})
+        except BaseException as exc:
+            # only pay for traceback formatting (and the traceback import)
+            # on the failure path; format from the exception object itself
+            # instead of going through sys.exc_info()
+            import traceback
+
+            exc_text = "".join(
+                traceback.format_exception(type(exc), exc, exc.__traceback__)
+            )
+            if state.flags & _STARTUP_COMPLETE:
+                await send({"type": "lifespan.shutdown.failed", "message": exc_text})
+            else:
+                await send({"type": "lifespan.startup.failed", "message": exc_text})
+            raise
+        else:
+            # even if the app sent "lifespan.shutdown.complete" we
+            # intercepted and discarded it; we send it once we are fully done
+            await send(_SHUTDOWN_COMPLETE_MSG)
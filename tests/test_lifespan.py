@@ -45,6 +45,74 @@ def test_single_lifespan_application_supports_lifespan() -> None:
     assert inner_lifespan.teardown_called  # type: ignore #  pragma: no cover
 
 
+def test_lifespan_passed_as_class_factory() -> None:
+    # a class itself is a valid factory: it gets called with the wrapped
+    # app and its instances are the context managers to enter
+
+    events: List[str] = []
+
+    class Lifespan:
+        def __init__(self, app: ASGIApp) -> None:
+            events.append("init")
+
+        async def __aenter__(self) -> None:
+            events.append("setup")
+
+        async def __aexit__(self, *args: Any) -> Union[bool, None]:
+            events.append("teardown")
+            return None
+
+    app = LifespanMiddleware(app=Starlette(), lifespan=Lifespan)
+
+    with TestClient(app):
+        assert events == ["init", "setup"]
+
+    assert events == ["init", "setup", "teardown"]
+
+
+def test_assume_lifespan() -> None:
+    # when the wrapped app is known to implement the lifespan protocol
+    # the fallback machinery can be skipped entirely
+
+    outer_lifespan = TrackingLifespan()
+    inner_lifespan = TrackingLifespan()
+
+    app = LifespanMiddleware(
+        app=Starlette(lifespan=inner_lifespan),
+        lifespan=outer_lifespan,
+        assume_lifespan=True,
+    )
+
+    with TestClient(app):
+        assert outer_lifespan.setup_called
+        assert inner_lifespan.setup_called
+
+    assert outer_lifespan.teardown_called
+    assert inner_lifespan.teardown_called  # type: ignore #  pragma: no cover
+
+
+def test_lifespan_passed_as_context_manager() -> None:
+    # the lifespan can be a ready-made async context manager instead of
+    # a callable that returns one; it is entered/exited as-is
+
+    events: List[str] = []
+
+    class Lifespan:
+        async def __aenter__(self) -> None:
+            events.append("setup")
+
+        async def __aexit__(self, *args: Any) -> Union[bool, None]:
+            events.append("teardown")
+            return None
+
+    app = LifespanMiddleware(app=Starlette(), lifespan=Lifespan())
+
+    with TestClient(app):
+        assert events == ["setup"]
+
+    assert events == ["setup", "teardown"]
+
+
 async def no_lifespan_app_does_nothing(
     scope: Scope, receive: Receive, send: Send
 ) -> None:
@@ -177,6 +245,88 @@ async def test_lifespan_teardown_failure() -> None:
     assert sent_messages == ["lifespan.startup.complete", "lifespan.shutdown.failed"]
 
 
+@pytest.mark.anyio
+async def test_lifespan_suppresses_exception() -> None:
+    # a lifespan whose __aexit__ returns True swallows the exception,
+    # just like it would under `async with`
+    # the handshake should still finish with "lifespan.shutdown.complete"
+    # and nothing should propagate to the server
+
+    class MyException(Exception):
+        pass
+
+    class SuppressingLifespan:
+        async def __aenter__(self) -> None:
+            pass
+
+        async def __aexit__(self, *args: Any) -> bool:
+            return True
+
+    async def bad_app(scope: Scope, receive: Receive, send: Send) -> None:
+        await receive()
+        await send({"type": "lifespan.startup.failed"})
+        raise MyException
+
+    app = LifespanMiddleware(app=bad_app, lifespan=SuppressingLifespan())
+
+    scope = {"type": "lifespan"}
+
+    sent_messages: List[str] = []
+
+    async def rcv_gen() -> AsyncIterator[Message]:
+        yield {"type": "lifespan.startup"}
+
+    async def send(message: Message) -> None:
+        sent_messages.append(message["type"])
+
+    rcv = rcv_gen()
+
+    await app(scope, rcv.__anext__, send)
+
+    assert sent_messages == ["lifespan.startup.failed", "lifespan.shutdown.complete"]
+
+
+@pytest.mark.anyio
+async def test_unrecognized_message_type_is_forwarded() -> None:
+    # wrapped_send only tracks the four lifespan events
+    # anything else should be passed through to the server untouched
+    # and must not disturb the handshake bookkeeping
+
+    lifespan = TrackingLifespan()
+
+    async def app(scope: Scope, receive: Receive, send: Send) -> None:
+        await receive()
+        await send({"type": "lifespan.custom.event"})
+        await send({"type": "lifespan.startup.complete"})
+        await receive()
+        await send({"type": "lifespan.shutdown.complete"})
+
+    app = LifespanMiddleware(app=app, lifespan=lifespan)
+
+    scope = {"type": "lifespan"}
+
+    sent_messages: List[str] = []
+
+    async def rcv_gen() -> AsyncIterator[Message]:
+        yield {"type": "lifespan.startup"}
+        yield {"type": "lifespan.shutdown"}
+
+    async def send(message: Message) -> None:
+        sent_messages.append(message["type"])
+
+    rcv = rcv_gen()
+
+    await app(scope, rcv.__anext__, send)
+
+    assert sent_messages == [
+        "lifespan.custom.event",
+        "lifespan.startup.complete",
+        "lifespan.shutdown.complete",
+    ]
+    assert lifespan.setup_called
+    assert lifespan.teardown_called
+
+
 def test_application_lifespan_fails_with_exception_during_setup() -> None:
     # the application's lifespan fails to run and raises an exception during it's setup
 